@@ -1,89 +1,273 @@
+import os
 from os import path
+from functools import partial
 import numpy as np
 import json
+import mmap
 import pickle
-from typing import Tuple
+from typing import Any, Sequence, Tuple, Union
 from argparse import Namespace
-import random
 
 
 import torch
 from torch.utils.data import Dataset, DataLoader, SequentialSampler, DistributedSampler
+from torch.nn.utils.rnn import pad_sequence
 from lightning.pytorch.core import LightningDataModule
 
 from esm.inverse_folding import util
 from esm import Alphabet
+from esm.data import BatchConverter
+
+# header of pickles written by dump_pickle, never the start of a plain pickle
+PICKLE_MAGIC = b"\x00JESPR-PICKLE-OOB-v1\n"
+
+
+def dump_pickle(obj: Any, file_path: str) -> None:
+    """Pickle obj with protocol 5, writing its out-of-band buffers (eg: numpy
+    arrays) to a sibling .bin file so that load_pickle can memory-map them.
+    The .pkl starts with PICKLE_MAGIC, followed by the pickled buffer offsets
+    and the payload.
+
+    Args:
+        obj (Any): Object to pickle
+        file_path (str): Path of the .pkl file. Buffers go to the same path with a
+            .bin extension.
+    """
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+
+    # write to temporary files and move them into place: the existing .bin may
+    # still be memory-mapped (eg: obj itself was loaded with load_pickle), and
+    # truncating it would invalidate (SIGBUS) those mappings
+    buffers_path = path.splitext(file_path)[0] + ".bin"
+    offsets = []
+    with open(buffers_path + ".tmp", "wb") as f:
+        for buffer in buffers:
+            raw = buffer.raw()
+            # 64 byte align every buffer
+            f.write(b"\0" * (-f.tell() % 64))
+            offsets.append((f.tell(), f.tell() + raw.nbytes))
+            f.write(raw)
+
+    with open(file_path + ".tmp", "wb") as f:
+        f.write(PICKLE_MAGIC)
+        pickle.dump(offsets, f)
+        f.write(payload)
+
+    os.replace(buffers_path + ".tmp", buffers_path)
+    os.replace(file_path + ".tmp", file_path)
+
+
+def load_pickle(file_path: str) -> Any:
+    """Load a pickle written by dump_pickle. Its out-of-band buffers are
+    memory-mapped (read-only) from the .bin file instead of being copied.
+    Plain pickles (no PICKLE_MAGIC header) are loaded as is, even if a stale
+    .bin file is next to them.
+
+    Args:
+        file_path (str): Path of the .pkl file
+
+    Returns:
+        Any: Unpickled object
+    """
+    buffers_path = path.splitext(file_path)[0] + ".bin"
+    with open(file_path, "rb") as f:
+        if f.read(len(PICKLE_MAGIC)) != PICKLE_MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        assert path.exists(buffers_path), f"{buffers_path} not found"
+
+        offsets = pickle.load(f)
+        buffers = []
+        if offsets:
+            with open(buffers_path, "rb") as buffers_file:
+                buffers_mmap = mmap.mmap(
+                    buffers_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            buffers_view = memoryview(buffers_mmap)
+            buffers = [buffers_view[start:end] for start, end in offsets]
+        return pickle.load(f, buffers=buffers)
+
+
+def dataloader_kwargs(args: Namespace, num_workers: int, pin_memory: bool) -> dict:
+    """DataLoader kwargs for pinned memory and persistent, prefetching workers
+
+    Args:
+        args (Namespace): Args. Optional: prefetch_factor (int, default 4)
+        num_workers (int): Number of Workers
+        pin_memory (bool): Pin Memory
+
+    Returns:
+        dict: kwargs for DataLoader
+    """
+    kwargs = {"pin_memory": pin_memory}
+    # worker args are only valid with num_workers > 0
+    if num_workers > 0:
+        kwargs["persistent_workers"] = True
+        kwargs["prefetch_factor"] = getattr(args, "prefetch_factor", 4)
+    return kwargs
 
 
 class ESMDataset(Dataset):
-    def __init__(self, split: str, args: Namespace) -> None:
+    def __init__(self, split: str, esm2_alphabet: Alphabet, args: Namespace) -> None:
         """ESM Dataset: torch.utils.data.Dataset
 
+        Reads the memory-mapped shards written by scripts/build_indexed_dataset.py
+        from {data_dir}/{dataset_name}/{split}/:
+            - coords.npy: float32 (total_residues, 3, 3) coords of all proteins
+            - seqs.npy: uint8 (total_residues,) ASCII residue codes of all proteins
+            - confidence.npy: float32 (total_residues,) 1.0 where a residue's coords
+              are all finite, else 0.0
+            - missing.npy: bool (total_residues,) True where a residue's first atom
+              coords are missing (NaN), i.e. the residue is padding for ESM-IF
+            - offsets.npy: int64 (num_proteins + 1,) start of every protein
+
         Args:
             split (str): Split (train, val, test)
+            esm2_alphabet (Alphabet): ESM-2 Alphabet used to tokenize sequences
             args (Namespace): Args for ESMDataset. Must Contain:
                 - data_dir (str): Data Directory
                 - max_seq_len (int): Max Sequence length
+                - in_memory_dataset (bool, optional): Read the shards once into
+                    shared memory tensors instead of memory-mapping them. Costs
+                    dataset size x number of (DDP) ranks of /dev/shm, whereas
+                    memory-mapped shards share one page cache across ranks.
+                    Defaults to False.
         """
         self.args = args
+        self.in_memory = getattr(args, "in_memory_dataset", False)
         assert args.dataset_name in [
             "cath",
             "pdb",
             "pdb_extended",
         ], "Invalid Dataset Name"
-        with open(
-            path.join(args.data_dir, f"{args.dataset_name}/{split}.pkl"), "rb"
-        ) as f:
-            self.data = pickle.load(f)
+        self.split_dir = path.join(args.data_dir, args.dataset_name, split)
+        assert path.isdir(
+            self.split_dir
+        ), f"{self.split_dir} not found. Run scripts/build_indexed_dataset.py first"
+        self.load_shards()
+
+        # sequence lengths, cached once for filtering and the batch samplers
+        offsets = np.load(path.join(self.split_dir, "offsets.npy"))
+        self.starts = offsets[:-1]
+        self.seq_lens = np.diff(offsets).astype(np.int32)
 
         # filter data by sequence length
         if args.max_seq_len is not None:
             self.filter_data(args.max_seq_len, args.min_seq_len)
 
+        # ASCII residue code -> ESM-2 token lookup table
+        self.token_lut = np.full(256, esm2_alphabet.unk_idx, dtype=np.int64)
+        for tok in esm2_alphabet.all_toks:
+            if len(tok) == 1:
+                self.token_lut[ord(tok)] = esm2_alphabet.get_idx(tok)
+        self.token_prefix = np.array(
+            [esm2_alphabet.cls_idx] * esm2_alphabet.prepend_bos, dtype=np.int64
+        )
+        self.token_suffix = np.array(
+            [esm2_alphabet.eos_idx] * esm2_alphabet.append_eos, dtype=np.int64
+        )
+
+    def load_shards(self) -> None:
+        """Memory-map the coords, sequence, confidence and missing shards (read-only).
+        With in_memory, they are instead read once into shared memory tensors, so
+        the DataLoader workers of this process map the same pages rather than
+        each faulting them in from disk, eg: on network storage. DDP ranks are
+        separate processes that build their own dataset, so every rank holds its
+        own shared memory copy.
+        """
+        for shard in ["coords", "seqs", "confidence", "missing"]:
+            array = np.load(path.join(self.split_dir, f"{shard}.npy"), mmap_mode="r")
+            if self.in_memory:
+                # copy the memmap straight into shared memory, no private copy
+                dtype = torch.from_numpy(np.empty(0, dtype=array.dtype)).dtype
+                tensor = torch.empty(array.shape, dtype=dtype).share_memory_()
+                tensor.numpy()[:] = array
+                array = tensor
+            setattr(self, shard, array)
+
+    def __getstate__(self) -> dict:
+        # don't pickle the memory-mapped shards into (spawned) workers, they are
+        # mapped again on unpickling. Shared memory tensors are passed by handle.
+        state = self.__dict__.copy()
+        if not self.in_memory:
+            for shard in ["coords", "seqs", "confidence", "missing"]:
+                del state[shard]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if not self.in_memory:
+            self.load_shards()
+
     def filter_data(self, max_seq_len: int, min_seq_len: int) -> None:
         """Filter the dataset by sequence length
 
         Args:
             max_seq_len (int): Maximum sequence length
+            min_seq_len (int): Minimum sequence length
         """
-        data = []
-        for item in self.data:
-            if len(item["seq"]) <= max_seq_len and len(item["seq"]) >= min_seq_len:
-                data.append(item)
+        mask = (self.seq_lens <= max_seq_len) & (self.seq_lens >= min_seq_len)
 
         # update the dataset
-        self.data = data
+        self.starts = self.starts[mask]
+        self.seq_lens = self.seq_lens[mask]
 
     def __len__(self) -> int:
         """Returns the length of the dataset
 
         Returns:
-            _type_: _description_
+            int: Number of proteins
         """
-        return len(self.data)
+        return len(self.seq_lens)
 
-    def __getitem__(self, idx: int) -> Tuple[np.ndarray, None, str]:
+    def __getitem__(
+        self, idx: int
+    ) -> Tuple[np.ndarray, np.ndarray, str, torch.Tensor, np.ndarray]:
         """Returns the idx-th protein in the dataset
 
         Args:
             idx (int): Protein Index
 
         Returns:
-            Tuple[np.ndarray, None, str]: Protein Structure Data, None, Protein Sequence Data
+            Tuple[np.ndarray, np.ndarray, str, torch.Tensor, np.ndarray]: Protein
+                Structure Data, Per-residue Confidence, Protein Sequence Data,
+                ESM-2 Tokens, Per-residue Missing Coords
         """
-        # chunk where the idx-th protein is located
-        item = self.data[idx]
-        return item["coords"].astype(np.float32), None, item["seq"]
+        start = self.starts[idx]
+        end = start + self.seq_lens[idx]
+
+        # views of the memory-mapped (or shared memory) shards, no copy
+        coords = np.asarray(self.coords[start:end])
+        confidence = np.asarray(self.confidence[start:end])
+        seq_codes = np.asarray(self.seqs[start:end])
+        missing = np.asarray(self.missing[start:end])
+
+        tokens = np.concatenate(
+            (self.token_prefix, self.token_lut[seq_codes], self.token_suffix)
+        )
+        seq = seq_codes.tobytes().decode()
+        return coords, confidence, seq, torch.from_numpy(tokens), missing
 
 
 class ESMBatchSampler(torch.utils.data.BatchSampler):
-    def __init__(self, sampler, batch_size, drop_last):
+    def __init__(self, sampler, batch_size, drop_last, seed=None):
         """ESM Batch Sampler
 
+        Config is read from the dataset args, so that Lightning can re-instantiate
+        the sampler around a DistributedSampler with only (sampler, batch_size,
+        drop_last).
+
         Args:
-            data (list): Data from ESMDataset.data
-            args (Namespace): Namespace containing the following args:
-                - sampler (dict): Sampler args. Must contain: bin_size
+            sampler (Sampler): Sampler over an ESMDataset (uses ESMDataset.seq_lens)
+            batch_size (int): Batch Size
+            drop_last (bool): Drop Last
+            seed (int, optional): Shuffle seed. The batches of every epoch are
+                shuffled with seed + epoch, see set_epoch. Defaults to
+                args.sampler["seed"], else 0.
+            args (Namespace): ESMDataset args containing the following args:
+                - sampler (dict): Sampler args. Must contain: bin_size.
+                    Optional: jitter (bool, default True), seed (int, default 0)
                 - min_seq_len (int): Minimum Sequence Length
                 - max_seq_len (int): Maximum Sequence Length
                 - batch_size (int): Batch Size
@@ -94,47 +278,80 @@ class ESMBatchSampler(torch.utils.data.BatchSampler):
             self.dataset = sampler.dataset
 
         self.sampler = sampler
-        self.data = self.dataset.data
+        self.seq_lens = self.dataset.seq_lens
         self.batch_size = batch_size
         self.drop_last = drop_last
+        self.seed = self.dataset.args.sampler.get("seed", 0) if seed is None else seed
 
-        self.bins = self.create_bins()
-        self.batches = self.create_batches()
+        # Lightning only calls set_epoch on dataloader.sampler and
+        # dataloader.batch_sampler.sampler, never on the batch sampler itself:
+        # route the sampler's set_epoch here (and still to its own, if any)
+        self.sampler_set_epoch = getattr(sampler, "set_epoch", None)
+        sampler.set_epoch = self.set_epoch
+        self.epoch = None
+        self.set_epoch(0)
 
-    def create_bins(self) -> dict:
-        """Creates bin of data indices based on bin_size
+    def set_epoch(self, epoch: int) -> None:
+        """Reseed the shuffle with seed + epoch and rebuild the batches.
+        Lightning calls it through self.sampler.set_epoch at the start of every
+        train epoch and every validation run.
+
+        Args:
+            epoch (int): Epoch
+        """
+        if self.sampler_set_epoch is not None:
+            self.sampler_set_epoch(epoch)
+        if epoch == self.epoch:
+            return
+        self.epoch = epoch
+        self.rng = np.random.default_rng(self.seed + epoch)
+        self.batches = self.create_batches()
+        if type(self.sampler) == DistributedSampler:
+            # every rank builds the same batches from the same seed, keep an
+            # equal share of them per rank
+            num_replicas, rank = self.sampler.num_replicas, self.sampler.rank
+            num_batches = len(self.batches) // num_replicas * num_replicas
+            self.batches = self.batches[rank:num_batches:num_replicas]
+
+    def create_batches(self) -> list:
+        """Sorts the data indices by seq length, splits them into batches of
+        batch_size and shuffles the batches. With sampler["jitter"] (default),
+        indices are shuffled within bins of bin_size residues before splitting.
+        With drop_last, a random remainder is dropped before sorting, not the
+        longest sequences. All draws use the seed + epoch generator, so batch
+        contents (not only their order) change whenever set_epoch moves to a new
+        epoch. Without jitter, only the drop_last remainder and the batch order
+        change.
 
         Returns:
-            dict: Data indices mapped to different bins based on the data seq length
+            list: Batches of data indices
         """
-        bin_size = self.dataset.args.sampler["bin_size"]
-        bins = {
-            i: []
-            for i in range(
-                self.dataset.args.min_seq_len, self.dataset.args.max_seq_len, bin_size
+        indices = np.arange(len(self.seq_lens))
+        if self.drop_last:
+            # drop a random remainder before sorting, otherwise the dropped
+            # partial batch would always be the longest sequences. Redrawn every
+            # epoch, as Lightning reaches set_epoch through self.sampler
+            num_kept = len(indices) // self.batch_size * self.batch_size
+            indices = np.sort(self.rng.permutation(indices)[:num_kept])
+        seq_lens = self.seq_lens[indices]
+
+        if self.dataset.args.sampler.get("jitter", True):
+            # bin id as primary sort key, a random key within each bin
+            bin_size = self.dataset.args.sampler["bin_size"]
+            bin_ids = (seq_lens - self.dataset.args.min_seq_len) // bin_size
+            order = indices[np.lexsort((self.rng.random(len(indices)), bin_ids))]
+        else:
+            order = indices[np.argsort(seq_lens, kind="stable")]
+
+        num_full = len(order) // self.batch_size * self.batch_size
+        all_batches = order[:num_full].reshape(-1, self.batch_size)
+        all_batches = all_batches[self.rng.permutation(len(all_batches))].tolist()
+        if not self.drop_last and num_full < len(order):
+            # the partial batch goes to a random position among the full ones
+            all_batches.insert(
+                int(self.rng.integers(len(all_batches) + 1)),
+                order[num_full:].tolist(),
             )
-        }
-
-        data_lens = [len(item["seq"]) for item in self.data]
-        for data_idx, data_len in enumerate(data_lens):
-            for bin_idx in list(bins.keys()):
-                if data_len >= bin_idx and data_len < bin_idx + bin_size:
-                    bins[bin_idx].append(data_idx)
-                    break
-
-        for bin_idx in list(bins.keys()):
-            random.shuffle(bins[bin_idx])
-        return bins
-
-    def create_batches(self):
-        bins_flattened = []
-        for _, bin_items in self.bins.items():
-            bins_flattened += bin_items
-        all_batches = [
-            bins_flattened[i : i + self.batch_size]
-            for i in range(0, len(bins_flattened), self.batch_size)
-        ]
-        random.shuffle(all_batches)
         return all_batches
 
     def __iter__(self):
@@ -145,6 +362,258 @@ class ESMBatchSampler(torch.utils.data.BatchSampler):
         return len(self.batches)
 
 
+class PackedBatchSampler(ESMBatchSampler):
+    def __init__(self, sampler, batch_size=None, drop_last=False, seed=None):
+        """Packed Batch Sampler
+
+        Packs sequences into variable sized batches of at most `capacity` padded
+        residues each, i.e. len(batch) * max(seq_len in batch) <= capacity,
+        instead of a fixed number of sequences per batch. Batches are collated
+        dense (padded to their longest sequence), so the bound is on the padded
+        size rather than on the sum of sequence lengths.
+
+        Args:
+            sampler (Sampler): Sampler over an ESMDataset (uses ESMDataset.seq_lens)
+            batch_size (int, optional): Unused, batches are variable sized.
+            drop_last (bool, optional): Unused, every sequence is packed.
+                batch_size and drop_last are accepted so that Lightning can
+                re-instantiate the sampler around a DistributedSampler.
+            seed (int, optional): Shuffle seed, see ESMBatchSampler.
+            args (Namespace): ESMDataset args. sampler["packing"] may contain:
+                - capacity (int): Maximum number of padded residues per batch.
+                    Defaults to 4096.
+                - strategy (str): Packing strategy. One of:
+                    - shuffle_and_pack: O(n) sequential packing of shuffled
+                      sequences, sorted by length within windows of `window`
+                      sequences
+                    - first_fit_decreasing: First-Fit-Decreasing. Packs similar
+                      lengths together, i.e. less padding per batch.
+                    Defaults to "shuffle_and_pack".
+                - window (int): shuffle_and_pack window size. Larger windows pack
+                    more similar lengths together, smaller windows mix more
+                    between epochs. Defaults to 1024.
+        """
+        super().__init__(
+            sampler=sampler, batch_size=batch_size, drop_last=drop_last, seed=seed
+        )
+
+    def create_bins(self) -> list:
+        """Packs data indices into bins of at most `capacity` padded residues
+        using the configured strategy. Sequences longer than `capacity` get a bin
+        of their own.
+
+        Returns:
+            list: Bins of data indices
+        """
+        packing = self.dataset.args.sampler.get("packing", {})
+        capacity = packing.get("capacity", 4096)
+        strategy = packing.get("strategy", "shuffle_and_pack")
+        assert strategy in [
+            "shuffle_and_pack",
+            "first_fit_decreasing",
+        ], f"Invalid Packing Strategy: {strategy}"
+
+        if strategy == "shuffle_and_pack":
+            return self.shuffle_and_pack(capacity, packing.get("window", 1024))
+        return self.first_fit_decreasing(capacity)
+
+    def shuffle_and_pack(self, capacity: int, window: int) -> list:
+        """Shuffle the data indices, sort them by length within windows of
+        `window` indices and fill one open bin at a time, starting a new bin
+        whenever the next sequence does not fit.
+
+        Args:
+            capacity (int): Maximum number of padded residues per bin
+            window (int): Window size
+
+        Returns:
+            list: Bins of data indices
+        """
+        perm = self.rng.permutation(len(self.seq_lens))
+        # window id as primary sort key, seq length within each window
+        window_ids = np.arange(len(perm)) // window
+        order = perm[np.lexsort((self.seq_lens[perm], window_ids))]
+
+        seq_lens = self.seq_lens.tolist()
+        bins, cur_bin, cur_max = [], [], 0
+        for data_idx in order.tolist():
+            data_len = seq_lens[data_idx]
+            padded_len = max(cur_max, data_len)
+            if cur_bin and (len(cur_bin) + 1) * padded_len > capacity:
+                bins.append(cur_bin)
+                cur_bin, padded_len = [], data_len
+            cur_bin.append(data_idx)
+            cur_max = padded_len
+
+        if cur_bin:
+            bins.append(cur_bin)
+        return bins
+
+    def first_fit_decreasing(self, capacity: int) -> list:
+        """Place data indices, longest first, into the first bin with room left.
+        The first sequence of a bin is its longest, so a bin has room for
+        capacity // len(first sequence) sequences. A new bin is only opened when
+        every bin is full, so only the newest bin can have room: a single pass.
+
+        Args:
+            capacity (int): Maximum number of padded residues per bin
+
+        Returns:
+            list: Bins of data indices
+        """
+        bins, bin_size = [], 0
+        for data_idx in np.argsort(-self.seq_lens, kind="stable").tolist():
+            if not bins or len(bins[-1]) == bin_size:
+                bins.append([])
+                bin_size = max(capacity // int(self.seq_lens[data_idx]), 1)
+            bins[-1].append(data_idx)
+        return bins
+
+    def create_batches(self) -> list:
+        bins = self.create_bins()
+        return [bins[i] for i in self.rng.permutation(len(bins))]
+
+
+class PaddedCoordBatchConverter(util.CoordBatchConverter):
+    """ESM-IF CoordBatchConverter that copies coords straight into one
+    preallocated padded batch tensor, instead of converting, padding and
+    re-collating every protein as a separate tensor. Outputs are the same as
+    util.CoordBatchConverter.
+    """
+
+    def __init__(
+        self,
+        alphabet: Alphabet,
+        confidence_masked: bool = False,
+        return_tokens: bool = True,
+    ) -> None:
+        """
+        Args:
+            alphabet (Alphabet): ESM-IF Alphabet
+            confidence_masked (bool, optional): Confidences in the raw batch are
+                per-residue arrays that are already 0 where coords are missing
+                (eg: cached by ESMDataset), so the coord mask is not recomputed
+                from the batch coords. Defaults to False.
+            return_tokens (bool, optional): Tokenize the sequences with the ESM-IF
+                alphabet. If False, the tokens output is None. Defaults to True.
+        """
+        super().__init__(alphabet)
+        self.confidence_masked = confidence_masked
+        self.return_tokens = return_tokens
+
+    def __call__(
+        self,
+        raw_batch: Sequence[Tuple[np.ndarray, Any, str]],
+        device=None,
+        missing: Sequence[np.ndarray] = None,
+    ) -> Tuple[torch.tensor, torch.tensor, list, torch.tensor, torch.tensor]:
+        """
+        Args:
+            raw_batch (Sequence[Tuple[np.ndarray, Any, str]]): (coords, confidence, seq)
+                per protein. coords: float32 (L, 3, 3). confidence: None, float or
+                (L,) array. seq: str or None.
+            device (optional): Device to move the outputs to. Defaults to None.
+            missing (Sequence[np.ndarray], optional): Per protein (L,) bool arrays,
+                True where the first atom's coords are missing (eg: cached by
+                ESMDataset). Copied into padding_mask instead of computing it with
+                isnan over the batch coords. Defaults to None.
+
+        Returns:
+            tuple: coords, confidence, strs, tokens, padding_mask
+        """
+        self.alphabet.cls_idx = self.alphabet.get_idx("<cath>")
+        strs = [
+            "X" * len(coords) if seq is None else seq for coords, _, seq in raw_batch
+        ]
+        tokens = None
+        if self.return_tokens:
+            _, _, tokens = BatchConverter.__call__(self, [(None, seq) for seq in strs])
+
+        batch_size = len(raw_batch)
+        max_len = max(len(coords) for coords, _, _ in raw_batch)
+        coords = torch.full(
+            (batch_size, max_len + 2, *raw_batch[0][0].shape[1:]),
+            np.nan,
+            dtype=torch.float32,
+        )
+        confidence = torch.full((batch_size, max_len + 2), -1.0)
+        padding_mask = None
+        if missing is not None:
+            padding_mask = torch.ones((batch_size, max_len + 2), dtype=torch.bool)
+            padding_mask_np = padding_mask.numpy()
+
+        # fill through numpy views of the batch tensors: one copy per protein
+        coords_np, confidence_np = coords.numpy(), confidence.numpy()
+        for i, (cd, cf, _) in enumerate(raw_batch):
+            # pad beginning and end of each protein due to legacy reasons
+            coords_np[i, 0] = np.inf
+            coords_np[i, 1 : len(cd) + 1] = cd
+            coords_np[i, len(cd) + 1] = np.inf
+            confidence_np[i, 1 : len(cd) + 1] = 1.0 if cf is None else cf
+            if self.confidence_masked:
+                confidence_np[i, [0, len(cd) + 1]] = 0.0
+            if missing is not None:
+                # residues with missing coords are padding, the legacy pads are not
+                padding_mask_np[i, 0] = False
+                padding_mask_np[i, 1 : len(cd) + 1] = missing[i]
+                padding_mask_np[i, len(cd) + 1] = False
+
+        if device is not None:
+            coords = coords.to(device)
+            confidence = confidence.to(device)
+            tokens = tokens.to(device) if tokens is not None else None
+            if padding_mask is not None:
+                padding_mask = padding_mask.to(device)
+        if padding_mask is None:
+            padding_mask = torch.isnan(coords[:, :, 0, 0])
+        if self.confidence_masked:
+            confidence = confidence.masked_fill(padding_mask, -1.0)
+        else:
+            coord_mask = torch.isfinite(coords.sum(-2).sum(-1))
+            confidence = confidence * coord_mask + (-1.0) * padding_mask
+        return coords, confidence, strs, tokens, padding_mask
+
+
+def esm_collate_fn(
+    batch: list,
+    esm_if_batch_converter: PaddedCoordBatchConverter,
+    esm2_padding_idx: int,
+) -> Tuple[torch.tensor, torch.tensor, list, torch.tensor, torch.tensor]:
+    """
+    Collate Function to process each batch
+    through ESM-IF CoordBatch Converter and pad the pre-tokenized ESM-2 tokens.
+    Defined at module level so that only the converter and padding index are
+    pickled into DataLoader workers, not the whole DataLoader.
+
+    Args:
+        batch (list): List of individual items from dataset.__getitem__()
+        esm_if_batch_converter (PaddedCoordBatchConverter): ESM-IF Batch Converter
+        esm2_padding_idx (int): ESM-2 Alphabet padding index
+
+    Returns:
+        tuple: coords, confidence, strs, tokens, padding_mask
+    """
+    # Process ESM-2 -> sequences are pre-tokenized by ESMDataset, only pad them
+    tokens = pad_sequence(
+        [item[3] for item in batch],
+        batch_first=True,
+        padding_value=esm2_padding_idx,
+    )
+
+    # Process ESM-IF ->
+    (
+        coords,
+        confidence,
+        strs,
+        _,
+        padding_mask,
+    ) = esm_if_batch_converter(
+        [item[:3] for item in batch], missing=[item[4] for item in batch]
+    )
+
+    return coords, confidence, strs, tokens, padding_mask
+
+
 class ESMDataLoader(DataLoader):
     def __init__(
         self,
@@ -167,12 +636,21 @@ class ESMDataLoader(DataLoader):
             shuffle (bool): Shuffle
             num_workers (int): Number of Workers
             sampler(ESMSampler): Sampler
+            kwargs: Passed on to DataLoader. Eg: pin_memory, persistent_workers
         """
         self.esm2_alphabet = esm2_alphabet
         self.esm_if_alphabet = esm_if_alphabet
 
-        self.esm_if_batch_converter = util.CoordBatchConverter(self.esm_if_alphabet)
-        self.esm2_batch_converter = self.esm2_alphabet.get_batch_converter()
+        # ESMDataset returns confidences cached with missing coords masked out.
+        # The ESM-IF tokens are unused, only ESM-2 tokens are fed to the model
+        self.esm_if_batch_converter = PaddedCoordBatchConverter(
+            self.esm_if_alphabet, confidence_masked=True, return_tokens=False
+        )
+        collate_fn = partial(
+            esm_collate_fn,
+            esm_if_batch_converter=self.esm_if_batch_converter,
+            esm2_padding_idx=self.esm2_alphabet.padding_idx,
+        )
 
         if batch_sampler is None:
             super().__init__(
@@ -180,7 +658,8 @@ class ESMDataLoader(DataLoader):
                 batch_size=batch_size,
                 shuffle=shuffle,
                 num_workers=num_workers,
-                collate_fn=self.collate_fn,
+                collate_fn=collate_fn,
+                **kwargs,
             )
 
         else:
@@ -188,39 +667,69 @@ class ESMDataLoader(DataLoader):
                 dataset=dataset,
                 num_workers=num_workers,
                 batch_sampler=batch_sampler,
-                collate_fn=self.collate_fn,
+                collate_fn=collate_fn,
+                **kwargs,
             )
 
-    def collate_fn(
-        self, batch: list
-    ) -> Tuple[torch.tensor, torch.tensor, list, torch.tensor, torch.tensor]:
-        """
-        Collate Function to process each batch
-        through ESM-IF CoordBatch Converter and ESM2 Batch Converter
 
-        Args:
-            batch (list): List of individual items from dataset.__getitem__()
+class CudaPrefetcher:
+    def __init__(self, loader: DataLoader, device: torch.device = None) -> None:
+        """Wraps a DataLoader and copies the next batch to the GPU on a side CUDA
+        stream while the current batch is being computed on. The loader should use
+        pin_memory=True for the copies to be asynchronous.
 
-        Returns:
-            tuple: coords, confidence, strs, tokens, padding_mask
+        Args:
+            loader (DataLoader): DataLoader to prefetch from
+            device (torch.device, optional): CUDA device. Defaults to the current
+                CUDA device when iteration starts.
         """
-        # Prepare input seqs for esm2 batch converter as mentioned in
-        # the example here: https://github.com/facebookresearch/esm/blob/2b369911bb5b4b0dda914521b9475cad1656b2ac/README.md?plain=1#L176
-        inp_seqs = [("", item[2]) for item in batch]
-
-        # Process ESM-2 ->
-        _labels, _strs, tokens = self.esm2_batch_converter(inp_seqs)
-
-        # Process ESM-IF ->
-        (
-            coords,
-            confidence,
-            strs,
-            _,
-            padding_mask,
-        ) = self.esm_if_batch_converter(batch)
+        self.loader = loader
+        self.device = device
 
-        return coords, confidence, strs, tokens, padding_mask
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __getattr__(self, name: str):
+        # expose the loader's sampler / batch_sampler etc. to Lightning
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    @staticmethod
+    def to_device(batch, device: torch.device):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(device, non_blocking=True)
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(CudaPrefetcher.to_device(item, device) for item in batch)
+        return batch
+
+    @staticmethod
+    def record_stream(batch, stream: torch.cuda.Stream) -> None:
+        # tensors were allocated on the side stream, but are used on `stream`
+        if isinstance(batch, torch.Tensor):
+            batch.record_stream(stream)
+        elif isinstance(batch, (tuple, list)):
+            for item in batch:
+                CudaPrefetcher.record_stream(item, stream)
+
+    def __iter__(self):
+        device = self.device or torch.device("cuda", torch.cuda.current_device())
+        copy_stream = torch.cuda.Stream(device=device)
+        compute_stream = torch.cuda.current_stream(device)
+
+        prev_batch = None
+        for batch in self.loader:
+            with torch.cuda.stream(copy_stream):
+                batch = self.to_device(batch, device)
+            if prev_batch is not None:
+                yield prev_batch
+
+            compute_stream.wait_stream(copy_stream)
+            self.record_stream(batch, compute_stream)
+            prev_batch = batch
+
+        if prev_batch is not None:
+            yield prev_batch
 
 
 class ESMDataLightning(LightningDataModule):
@@ -239,6 +748,8 @@ class ESMDataLightning(LightningDataModule):
                 - data_dir (str): Data Directory
                 - split_ratio (int): Dataset split ratio. Eg: 0.8 (80% train, 20% val)
                 - max_seq_len (int): Max Sequence Length
+                - in_memory_dataset (bool, optional): Shared memory shards, one
+                    copy per (DDP) rank. See ESMDataset
                 - batch_size (int): Batch Size
                 - train_shuffle (bool): Train Shuffle
                 - train_num_workers (int): Train Loader - Number of Workers
@@ -246,6 +757,9 @@ class ESMDataLightning(LightningDataModule):
                 - val_shuffle (bool): Val Shuffle
                 - val_num_workers (int): Val Loader - Number of Workers
                 - val_pin_memory (bool): Val Loader - Pin Memory
+                - prefetch_factor (int, optional): Batches prefetched per worker
+                - cuda_prefetch (bool, optional): Copy train batches to the GPU
+                    on a side CUDA stream with CudaPrefetcher
 
         """
         super().__init__()
@@ -267,35 +781,58 @@ class ESMDataLightning(LightningDataModule):
             stage (str): Stage. Either "fit" or "test"
         """
         if stage == "fit":
-            self.train_dataset = ESMDataset(split="train", args=self.args)
-            self.val_dataset = ESMDataset(split="val", args=self.args)
+            self.train_dataset = ESMDataset(
+                split="train", esm2_alphabet=self.esm2_alphabet, args=self.args
+            )
+            self.val_dataset = ESMDataset(
+                split="val", esm2_alphabet=self.esm2_alphabet, args=self.args
+            )
         else:
-            self.test_dataset = ESMDataset(split="test", args=self.args)
+            self.test_dataset = ESMDataset(
+                split="test", esm2_alphabet=self.esm2_alphabet, args=self.args
+            )
 
         if self.args.sampler["enabled"]:
             if stage == "fit":
-                self.train_sampler = ESMBatchSampler(
-                    sampler=SequentialSampler(self.train_dataset),
-                    batch_size=self.args.batch_size,
-                    drop_last=True,
+                self.train_sampler = self.build_batch_sampler(
+                    self.train_dataset, drop_last=True
                 )
-                self.val_sampler = ESMBatchSampler(
-                    sampler=SequentialSampler(self.val_dataset),
-                    batch_size=self.args.batch_size,
-                    drop_last=True,
+                # evaluate on every sample
+                self.val_sampler = self.build_batch_sampler(
+                    self.val_dataset, drop_last=False
                 )
             else:
-                self.test_sampler = ESMBatchSampler(
-                    sampler=SequentialSampler(self.test_dataset),
-                    batch_size=self.args.batch_size,
-                    drop_last=True,
+                self.test_sampler = self.build_batch_sampler(
+                    self.test_dataset, drop_last=False
                 )
         else:
             self.train_sampler = None
             self.val_sampler = None
             self.test_sampler = None
 
-    def train_dataloader(self) -> ESMDataLoader:
+    def build_batch_sampler(
+        self, dataset: ESMDataset, drop_last: bool
+    ) -> ESMBatchSampler:
+        """Build the batch sampler for a dataset as configured in args.sampler
+
+        Args:
+            dataset (ESMDataset): Dataset to sample from
+            drop_last (bool): Drop Last
+
+        Returns:
+            ESMBatchSampler: PackedBatchSampler if packing is enabled,
+                else ESMBatchSampler
+        """
+        # both samplers read the rest of their config from dataset.args.sampler
+        if self.args.sampler.get("packing", {}).get("enabled", False):
+            return PackedBatchSampler(sampler=SequentialSampler(dataset))
+        return ESMBatchSampler(
+            sampler=SequentialSampler(dataset),
+            batch_size=self.args.batch_size,
+            drop_last=drop_last,
+        )
+
+    def train_dataloader(self) -> Union[ESMDataLoader, CudaPrefetcher]:
         assert self.train_dataset is not None, "Train Dataset is None"
 
         data_loader = ESMDataLoader(
@@ -306,7 +843,14 @@ class ESMDataLightning(LightningDataModule):
             shuffle=self.args.train_shuffle,
             num_workers=self.args.train_num_workers,
             batch_sampler=self.train_sampler,
+            **dataloader_kwargs(
+                self.args,
+                num_workers=self.args.train_num_workers,
+                pin_memory=self.args.train_pin_memory,
+            ),
         )
+        if getattr(self.args, "cuda_prefetch", False) and torch.cuda.is_available():
+            return CudaPrefetcher(data_loader)
         return data_loader
 
     def val_dataloader(self) -> ESMDataLoader:
@@ -319,6 +863,11 @@ class ESMDataLightning(LightningDataModule):
             shuffle=self.args.val_shuffle,
             num_workers=self.args.val_num_workers,
             batch_sampler=self.val_sampler,
+            **dataloader_kwargs(
+                self.args,
+                num_workers=self.args.val_num_workers,
+                pin_memory=self.args.val_pin_memory,
+            ),
         )
         return data_loader
 
@@ -332,6 +881,11 @@ class ESMDataLightning(LightningDataModule):
             shuffle=self.args.val_shuffle,
             num_workers=self.args.val_num_workers,
             batch_sampler=self.test_sampler,
+            **dataloader_kwargs(
+                self.args,
+                num_workers=self.args.val_num_workers,
+                pin_memory=self.args.val_pin_memory,
+            ),
         )
         return data_loader
 
@@ -1,5 +1,5 @@
 from os import path
-import pickle
+from functools import partial
 from typing import Tuple
 from argparse import Namespace
 
@@ -7,17 +7,21 @@ from argparse import Namespace
 import torch
 from esm.data import Alphabet
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
 from lightning.pytorch.core import LightningDataModule
 
+from data import dataloader_kwargs, load_pickle
+
 
 class StabilityDataset(Dataset):
-    def __init__(self, split: str, data_dir: str) -> None:
+    def __init__(self, split: str, data_dir: str, esm2_alphabet: Alphabet) -> None:
         """Stability Dataset
 
         Args:
             split (str): Split.
                 One of train, val, test
             data_dir (str): Data directory
+            esm2_alphabet (Alphabet): ESM2 Alphabet used to pre-tokenize sequences
 
         Raises:
             ValueError: If Split is invalid
@@ -28,8 +32,13 @@ class StabilityDataset(Dataset):
             "test",
         ], f"Invalid Split: {split}"
 
-        with open(path.join(data_dir, f"stability/{split}.pkl"), "rb") as f:
-            self.data = pickle.load(f)
+        self.data = load_pickle(path.join(data_dir, f"stability/{split}.pkl"))
+
+        # tokenize sequences once, collate_fn only pads them
+        esm2_batch_converter = esm2_alphabet.get_batch_converter()
+        self.tokens = [
+            esm2_batch_converter([("", entry["primary"])])[2][0] for entry in self.data
+        ]
 
     def __len__(self) -> int:
         return len(self.data)
@@ -41,10 +50,33 @@ class StabilityDataset(Dataset):
             index (int): Index
 
         Returns:
-            Tuple: (AA Sequence, Class Label)
+            Tuple: (ESM2 Tokens of the AA Sequence, Class Label)
         """
         entry = self.data[index]
-        return (entry["primary"], entry["stability_score"][0])
+        return (self.tokens[index], entry["stability_score"][0])
+
+
+def stability_collate_fn(batch: list, esm2_padding_idx: int) -> Tuple:
+    """
+    Collate Function to process each batch
+    by padding the pre-tokenized ESM2 tokens. Defined at module level so that
+    only the padding index is pickled into DataLoader workers.
+
+    Args:
+        batch (list): List of individual items from dataset.__getitem__()
+        esm2_padding_idx (int): ESM2 Alphabet padding index
+
+    Returns:
+        tuple: tokens, labels
+    """
+    tokens = pad_sequence(
+        [item[0] for item in batch],
+        batch_first=True,
+        padding_value=esm2_padding_idx,
+    )
+    stability_score = torch.tensor([item[1] for item in batch], dtype=torch.float32)
+
+    return tokens, stability_score
 
 
 class StabilityLightning(LightningDataModule):
@@ -52,12 +84,15 @@ class StabilityLightning(LightningDataModule):
         """Definite Stability Lightning module
 
         Args:
-            esm2_alphabet (Alphabet): ESM2 Alphabet for batch_converter
+            esm2_alphabet (Alphabet): ESM2 Alphabet to tokenize sequences
             args (Namespace): Args
         """
         super().__init__()
         self.args = args
-        self.esm2_batch_converter = esm2_alphabet.get_batch_converter()
+        self.esm2_alphabet = esm2_alphabet
+        self.collate_fn = partial(
+            stability_collate_fn, esm2_padding_idx=esm2_alphabet.padding_idx
+        )
 
     def prepare_data(self):
         pass
@@ -67,38 +102,20 @@ class StabilityLightning(LightningDataModule):
             self.train_dataset = StabilityDataset(
                 split="train",
                 data_dir=self.args.data_dir,
+                esm2_alphabet=self.esm2_alphabet,
             )
             self.val_dataset = StabilityDataset(
                 split="val",
                 data_dir=self.args.data_dir,
+                esm2_alphabet=self.esm2_alphabet,
             )
         elif stage == "test":
             self.test_dataset = StabilityDataset(
                 split="test",
                 data_dir=self.args.data_dir,
+                esm2_alphabet=self.esm2_alphabet,
             )
 
-    def collate_fn(self, batch: list) -> Tuple[str, int]:
-        """
-        Collate Function to process each batch
-        through ESM2 Batch Converter
-
-        Args:
-            batch (list): List of individual items from dataset.__getitem__()
-
-        Returns:
-            tuple: tokens, labels
-        """
-        # Prepare input seqs for esm2 batch converter as mentioned in
-        # the example here: https://github.com/facebookresearch/esm/blob/2b369911bb5b4b0dda914521b9475cad1656b2ac/README.md?plain=1#L176
-        inp_seqs = [("", item[0]) for item in batch]
-        stability_score = torch.tensor([item[1] for item in batch], dtype=torch.float32)
-
-        # Process ESM-2 ->
-        _labels, _strs, tokens = self.esm2_batch_converter(inp_seqs)
-
-        return tokens, stability_score
-
     def train_dataloader(self) -> DataLoader:
         """Return Train Data Loader
 
@@ -112,6 +129,11 @@ class StabilityLightning(LightningDataModule):
             shuffle=self.args.train_shuffle,
             num_workers=self.args.train_num_workers,
             collate_fn=self.collate_fn,
+            **dataloader_kwargs(
+                self.args,
+                num_workers=self.args.train_num_workers,
+                pin_memory=self.args.train_pin_memory,
+            ),
         )
         return dataloader
 
@@ -128,6 +150,11 @@ class StabilityLightning(LightningDataModule):
             shuffle=self.args.train_shuffle,
             num_workers=self.args.train_num_workers,
             collate_fn=self.collate_fn,
+            **dataloader_kwargs(
+                self.args,
+                num_workers=self.args.train_num_workers,
+                pin_memory=self.args.val_pin_memory,
+            ),
         )
         return dataloader
 
@@ -148,6 +175,11 @@ class StabilityLightning(LightningDataModule):
             shuffle=self.args.train_shuffle,
             num_workers=self.args.train_num_workers,
             collate_fn=self.collate_fn,
+            **dataloader_kwargs(
+                self.args,
+                num_workers=self.args.train_num_workers,
+                pin_memory=self.args.val_pin_memory,
+            ),
         )
         return dataloader
 
@@ -0,0 +1,114 @@
+"""
+Convert the pickled ESMDataset splits into the memory-mapped shards read by
+data.ESMDataset. For every split, {data_dir}/{dataset_name}/{split}.pkl
+(a list of {"seq": str, "coords": np.ndarray (L, 3, 3)} dicts) is written to
+{data_dir}/{dataset_name}/{split}/ as:
+
+    coords.npy: float32 (total_residues, 3, 3), coords of all proteins concatenated
+    seqs.npy: uint8 (total_residues,), ASCII residue codes of all sequences concatenated
+    confidence.npy: float32 (total_residues,), 1.0 where a residue's coords are all
+        finite, else 0.0. Cached so that collate doesn't recompute the coord mask
+    missing.npy: bool (total_residues,), True where a residue's first atom coords
+        are NaN. Cached so that collate doesn't recompute the ESM-IF padding mask
+    offsets.npy: int64 (num_proteins + 1,), start of every protein in coords/seqs
+
+Usage (from the base directory of this repository):
+
+python scripts/build_indexed_dataset.py --data_dir data/ --dataset_name pdb
+"""
+
+import os
+import sys
+from os import path
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+sys.path.append(path.abspath(path.join(__file__, "../..")))
+from data import load_pickle
+
+
+def build_split(data_dir: str, dataset_name: str, split: str) -> None:
+    """Write the coords, seqs, confidence, missing and offsets shards of a split
+
+    Args:
+        data_dir (str): Data Directory
+        dataset_name (str): Dataset Name (cath, pdb, pdb_extended)
+        split (str): Split (train, val, test)
+    """
+    data = load_pickle(path.join(data_dir, f"{dataset_name}/{split}.pkl"))
+
+    split_dir = path.join(data_dir, dataset_name, split)
+    os.makedirs(split_dir, exist_ok=True)
+
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item["seq"]) for item in data])
+    total_residues = int(offsets[-1])
+
+    # fill the shards protein by protein instead of concatenating in memory
+    coords = open_memmap(
+        path.join(split_dir, "coords.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(total_residues, 3, 3),
+    )
+    seqs = open_memmap(
+        path.join(split_dir, "seqs.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(total_residues,),
+    )
+    confidence = open_memmap(
+        path.join(split_dir, "confidence.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(total_residues,),
+    )
+    missing = open_memmap(
+        path.join(split_dir, "missing.npy"),
+        mode="w+",
+        dtype=np.bool_,
+        shape=(total_residues,),
+    )
+    for i, item in enumerate(data):
+        assert len(item["coords"]) == len(item["seq"]), f"Length mismatch: {i}"
+        coords[offsets[i] : offsets[i + 1]] = item["coords"]
+        seqs[offsets[i] : offsets[i + 1]] = np.frombuffer(
+            item["seq"].encode("ascii"), dtype=np.uint8
+        )
+        confidence[offsets[i] : offsets[i + 1]] = np.isfinite(item["coords"]).all(
+            axis=(1, 2)
+        )
+        missing[offsets[i] : offsets[i + 1]] = np.isnan(item["coords"][:, 0, 0])
+    coords.flush()
+    seqs.flush()
+    confidence.flush()
+    missing.flush()
+    np.save(path.join(split_dir, "offsets.npy"), offsets)
+
+    print(f"{dataset_name}/{split}: {len(data)} proteins, {total_residues} residues")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--data_dir", type=str, default="data/", help="Data Directory"
+    )
+    arg_parser.add_argument(
+        "--dataset_name",
+        type=str,
+        choices=["cath", "pdb", "pdb_extended"],
+        required=True,
+        help="Dataset Name",
+    )
+    arg_parser.add_argument(
+        "--splits",
+        type=str,
+        nargs="+",
+        default=["train", "val", "test"],
+        help="Splits to convert",
+    )
+    args = arg_parser.parse_args()
+
+    for split in args.splits:
+        build_split(args.data_dir, args.dataset_name, split)
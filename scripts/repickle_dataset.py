@@ -0,0 +1,30 @@
+"""
+Re-serialize pickled datasets with pickle protocol 5 (see data.dump_pickle).
+Large numpy arrays are written out-of-band to a sibling .bin file that
+data.load_pickle memory-maps, instead of deserializing (copying) them in every
+process. Each .pkl is rewritten in place. Files are read with data.load_pickle,
+so running the script again on converted files is a no-op rewrite.
+
+Usage (from the base directory of this repository):
+
+python scripts/repickle_dataset.py data/stability/train.pkl data/stability/val.pkl
+"""
+
+import sys
+from os import path
+import argparse
+
+sys.path.append(path.abspath(path.join(__file__, "../..")))
+from data import dump_pickle, load_pickle
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "file_paths", type=str, nargs="+", help="Paths of the .pkl files"
+    )
+    args = arg_parser.parse_args()
+
+    for file_path in args.file_paths:
+        obj = load_pickle(file_path)
+        dump_pickle(obj, file_path)
+        print(f"Re-serialized {file_path}")